@@ -1,9 +1,36 @@
 import os
+import warnings
 from pyopenms import *
 import numpy as np
 import pandas as pd
 
 
+def _match_features(ams_mz, ams_rt, cm_mz, cm_rt, atol=1e-05, rtol=1e-05):
+    """Return index pairs (ams, cm) of AMS results and features with same mz and RT within tolerance."""
+    # tolerance per ams result (same as np.isclose)
+    mz_tol = atol + rtol * np.abs(ams_mz)
+    rt_tol = atol + rtol * np.abs(ams_rt)
+
+    # look up features in a window around each ams mz in the sorted cm mz values, the window is twice the
+    # tolerance so rounding in ams_mz +- mz_tol can't drop boundary pairs (the exact check follows below)
+    order = np.argsort(cm_mz, kind="stable")
+    cm_mz_sorted = cm_mz[order]
+    lo = np.searchsorted(cm_mz_sorted, ams_mz - 2 * mz_tol, side="left")
+    hi = np.searchsorted(cm_mz_sorted, ams_mz + 2 * mz_tol, side="right")
+    counts = hi - lo
+    ams_idx = np.repeat(np.arange(len(ams_mz)), counts)
+    cm_idx = order[
+        np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+    ]
+
+    # keep pairs where mz and rt are within tolerance
+    in_tolerance = (np.abs(cm_mz[cm_idx] - ams_mz[ams_idx]) <= mz_tol[ams_idx]) & (
+        np.abs(cm_rt[cm_idx] - ams_rt[ams_idx]) <= rt_tol[ams_idx]
+    )
+
+    return ams_idx[in_tolerance], cm_idx[in_tolerance]
+
+
 def annotate_cm_df(cm_df, ams_df, keep_unidentified=False):
     """Annotates ConsensusMap DataFrame with identifications and adducts from AccurateMassSearch.
 
@@ -19,38 +46,43 @@ def annotate_cm_df(cm_df, ams_df, keep_unidentified=False):
     pandas.DataFrame
         ConsensusMap with extra column containing ID name and adduct.
     """
-    # create empty columns for ids and adducts
-    cm_df["id"] = pd.Series(["" for _ in range(len(cm_df.index))])
-    cm_df["adduct"] = pd.Series(["" for _ in range(len(cm_df.index))])
     # create unique index
     cm_df.index = np.arange(0, len(cm_df.index))
-    # loop over ams results and annotate id and adduct in cm_df if mz and rt are within tolerance (basically if they are the same, the floats can differ slightly)
-    for ams_rt, ams_mz, ams_name, ams_adduct in zip(
-        ams_df["retention_time"],
-        ams_df["exp_mass_to_charge"],
-        ams_df["description"],
-        ams_df["opt_global_adduct_ion"],
-    ):
-        indices = cm_df.index[
-            np.isclose(cm_df["mz"], float(ams_mz), atol=1e-05)
-            & np.isclose(cm_df["RT"], float(ams_rt), atol=1e-05)
-        ].tolist()
-
-        
-        for index in indices:
-            if ams_name != 'null':
-                cm_df.loc[index, "id"] += ams_name + ";"
-            if ams_adduct != "null":
-                cm_df.loc[index, "adduct"] += (
-                    "["
-                    + ams_adduct.split(";")[0]
-                    + "]"
-                    + ams_adduct.split(";")[1]
-                    + ";"
-                )
-    # remove last : from ids and adducts
-    cm_df["id"] = [item[:-1] if ";" in item else "" for item in cm_df["id"]]
-    cm_df["adduct"] = [item[:-1] if ";" in item else "" for item in cm_df["adduct"]]
+
+    ams_df = ams_df.copy()
+    # format adducts from AccurateMassSearch (e.g. M-H;1-) as [M-H]1-
+    adduct_parts = ams_df["opt_global_adduct_ion"].str.split(";", n=1)
+    ams_df["adduct_fmt"] = "[" + adduct_parts.str[0] + "]" + adduct_parts.str[1]
+    ams_mz = ams_df["exp_mass_to_charge"].astype(float).to_numpy()
+    ams_rt = ams_df["retention_time"].astype(float).to_numpy()
+    cm_mz = cm_df["mz"].to_numpy()
+    cm_rt = cm_df["RT"].to_numpy()
+
+    # match ams results with features (basically if they are the same, the floats can differ slightly)
+    ams_idx, cm_idx = _match_features(ams_mz, ams_rt, cm_mz, cm_rt)
+    matches = (
+        ams_df[["description", "opt_global_adduct_ion", "adduct_fmt"]]
+        .iloc[ams_idx]
+        .assign(index=cm_idx)
+    )
+
+    # join all ids and adducts per feature separated by ;
+    ids = (
+        matches.loc[matches["description"] != "null"]
+        .groupby("index")["description"]
+        .agg(";".join)
+    )
+    adducts = (
+        matches.loc[matches["opt_global_adduct_ion"] != "null"]
+        .groupby("index")["adduct_fmt"]
+        .agg(";".join)
+    )
+
+    cm_df = cm_df.join(
+        pd.concat([ids.rename("id"), adducts.rename("adduct")], axis=1)
+    )
+    # features without match get empty ids and adducts
+    cm_df[["id", "adduct"]] = cm_df[["id", "adduct"]].fillna("")
     # remove unnecessary columns sequence and charge
     cm_df = cm_df.drop(columns=["sequence", "charge"])
 
@@ -76,7 +108,7 @@ def filter_df(df, q):
     pandas.DataFrame
         Filtered DataFrame.
     """
-    return df[df["quality"] > 0]
+    return df.loc[df["quality"] > q]
 
 
 def group_metabolites_ams(df):
@@ -126,7 +158,7 @@ def group_metabolites_ffmid(fms):
         df = df.groupby(df.index).sum()
         dfs.append(df)
 
-    return pd.concat(dfs, axis=1).replace(np.NaN, 0)
+    return pd.concat(dfs, axis=1).fillna(0)
 
 
 def combine_neg_pos_ids(df_neg, df_pos):
@@ -144,9 +176,10 @@ def combine_neg_pos_ids(df_neg, df_pos):
     pandas.DataFrame
         DataFrame containing metabolite intensities summed up from negative and positive ion mode measurements.
     """
-    df = pd.concat([df_neg, df_pos])
-    df = df.groupby(df.index).sum()
-    return df
+    # ids are unique per DataFrame, add them aligned on index instead of concatenating and grouping
+    df = df_neg.add(df_pos, fill_value=0).fillna(0)
+    # keep sample order of the input DataFrames
+    return df[df_neg.columns.union(df_pos.columns, sort=False)]
 
 
 def normalize_max(df):
@@ -182,13 +215,16 @@ def maximum_absolute_scaling_per_column(df):
     pandas.DataFrame
         Normalized DataFrame (each column is normalized on it's maximum value)
     """
-    # copy the dataframe
-    df_scaled = df.copy()
-    # apply maximum absolute scaling
-    for column in df_scaled.columns:
-        column_values = pd.to_numeric(df_scaled[column])
-        df_scaled[column] = round(column_values / column_values.abs().max(), 2)
-    return df_scaled
+    # apply maximum absolute scaling to all columns at once
+    values = df.to_numpy(dtype=np.float64)
+    if values.size == 0:
+        return pd.DataFrame(values, index=df.index, columns=df.columns)
+    # maximum ignores NaN like Series.max, all-NaN columns stay NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        maximum = np.nanmax(np.abs(values), axis=0, keepdims=True)
+    scaled = np.round(values / maximum, 2)
+    return pd.DataFrame(scaled, index=df.index, columns=df.columns)
 
 
 def get_mean_std_change_df(df, sample_pairs):
@@ -201,11 +237,12 @@ def get_mean_std_change_df(df, sample_pairs):
     Parameters
     ----------
     df : pandas.DataFrame
-        Input DataFrame with ID names as index and sample names (without the replicate specification)
-        as columns. Only columns specified in sample_pairs will be considered for calculation!
+        Input DataFrame with ID names as index and sample names with replicate specification as columns.
+        The replicate specification follows the last # (e.g. samplename#1), columns without # are ignored.
+        Only columns specified in sample_pairs will be considered for calculation!
     sample_pairs : list of tuples
         Sample names to be compared with each other for fold change calculations (eg. [('control', 'treatment')])
-        will calculate the log2 fold change of normalized (on maximum) values for the means of treatment / control.
+        will calculate the log2 fold change of the means (+1) of treatment / control.
 
     Returns
     -------
@@ -217,20 +254,33 @@ def get_mean_std_change_df(df, sample_pairs):
         DataFrame with log2 fold change values for the specified sample pairs.
     """
 
-    df_mean = pd.DataFrame(index=df.index)
-    df_std = pd.DataFrame(index=df.index)
-    df_change = pd.DataFrame(index=df.index)
-    
     # replicate numbers should be at the end of the file name separated with # (e.g. samplename#1)
-    for name in [sample for sample_pair in sample_pairs for sample in sample_pair]:
-        replicates = [c for c in df.columns if c.startswith(name + "#")]
-        df_mean[name] = df[replicates].mean(axis=1)
-        df_std[name] = df[replicates].std(axis=1)
-
-    for pair in sample_pairs:
-        df_pair = normalize_max(df_mean[[pair[0], pair[1]]] + 1)
-        df_change[pair[1] + "/" + pair[0]] = np.log2(
-            df_pair[pair[1]] / df_pair[pair[0]]
-        )
+    has_replicate = df.columns.str.contains("#", regex=False)
+    sample_names = df.columns.str.rsplit("#", n=1).str[0]
+    replicate_groups = {
+        name: df.columns[has_replicate & (sample_names == name)]
+        for sample_pair in sample_pairs
+        for name in sample_pair
+    }
+
+    # calculate mean and std on the replicate values of each sample at once
+    means = {}
+    stds = {}
+    for name, replicates in replicate_groups.items():
+        values = df[replicates].to_numpy(dtype=np.float64)
+        # all-NaN rows and single replicates give NaN like pandas mean/std, without RuntimeWarnings
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            means[name] = np.nanmean(values, axis=1)
+            stds[name] = np.nanstd(values, axis=1, ddof=1)
+    df_mean = pd.DataFrame(means, index=df.index)
+    df_std = pd.DataFrame(stds, index=df.index)
+
+    # fold change of means + 1 (normalizing both means on their maximum cancels out in the ratio)
+    changes = {
+        pair[1] + "/" + pair[0]: np.log2((means[pair[1]] + 1) / (means[pair[0]] + 1))
+        for pair in sample_pairs
+    }
+    df_change = pd.DataFrame(changes, index=df.index)
 
     return df_mean, df_std, df_change
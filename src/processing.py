@@ -1,7 +1,9 @@
 import csv
+import functools
+import io
 import os
+import tempfile
 from pyopenms import *
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
@@ -18,24 +20,98 @@ def _get_mzML_name_from_fm(fm):
     return name
 
 
-def load_experiment(path_to_mzML):
+def _get_params(algorithm, custom_params):
+    """Return the default Param of an OpenMS algorithm class updated with custom parameters (name, value)."""
+    # list values as tuples (hashable), names may mix str and bytes
+    key = tuple(
+        sorted(
+            ((k, tuple(v) if isinstance(v, list) else v) for k, v in custom_params.items()),
+            key=lambda kv: str(kv[0]),
+        )
+    )
+    try:
+        hash(key)
+    except TypeError:
+        return _build_params(algorithm, key)
+    return _get_params_cached(algorithm, key)
+
+
+def _build_params(algorithm, custom_params):
+    params = algorithm().getDefaults()
+    for k, v in custom_params:
+        params.setValue(k, list(v) if isinstance(v, tuple) else v)
+    return params
+
+
+@functools.lru_cache(maxsize=32)
+def _get_params_cached(algorithm, custom_params):
+    """Param objects are cached per algorithm and parameters, setParameters copies them."""
+    return _build_params(algorithm, custom_params)
+
+
+def load_experiment(path_to_mzML, use_cache=False):
     """Loads a MSExperiment from file.
 
+    With use_cache the last parsed files are kept (until they are modified) and repeated loads return a copy
+    of the cached MSExperiment. Cached files stay in memory until clear_experiment_cache is called.
+
     Parameters
     ----------
     path_to_mzML : str
         Path to the mzML file location.
+    use_cache : bool (default : False)
+        Use and fill the cache of parsed mzML files (for files that are loaded repeatedly).
 
     Returns
     -------
     pyopenms.MSExperiment
         MSExperiment loaded from file.
     """
+    if not use_cache:
+        return _load_experiment(path_to_mzML)
+
+    path_to_mzML = os.path.abspath(path_to_mzML)
+    # return a copy, MSExperiments get modified in place (e.g. filter_experiment)
+    return MSExperiment(_load_experiment_cached(path_to_mzML, os.path.getmtime(path_to_mzML)))
+
+
+def _load_experiment(path_to_mzML):
+    """Load MSExperiment from mzML file without cache."""
     exp = MSExperiment()
     MzMLFile().load(path_to_mzML, exp)
 
     return exp
 
+
+@functools.lru_cache(maxsize=2)
+def _load_experiment_cached(path_to_mzML, mtime):
+    """Load MSExperiment from mzML file, cached per path and modification time (mtime)."""
+    return _load_experiment(path_to_mzML)
+
+
+def clear_experiment_cache():
+    """Remove all MSExperiments cached by load_experiment from memory."""
+    _load_experiment_cached.cache_clear()
+
+
+def load_feature_map(path_to_featureXML):
+    """Loads a FeatureMap from file.
+
+    Parameters
+    ----------
+    path_to_featureXML : str
+        Path to the featureXML file location.
+
+    Returns
+    -------
+    pyopenms.FeatureMap
+        FeatureMap loaded from file.
+    """
+    fm = FeatureMap()
+    FeatureXMLFile().load(path_to_featureXML, fm)
+
+    return fm
+
 # def centroid(exp_raw):
 #     """Centroids a MSExperiment with PeakPickerHiRes.
 
@@ -72,11 +148,11 @@ def filter_experiment(exp, start=0, end=-1):
         Input MSExperiment filtered by RT.
     """
     exp.updateRanges()
-    spectra = exp.getSpectra()
+    # iterate spectra one by one for RTs, only spectra within RT range get copied for the filtered experiment
+    rts = np.fromiter((spec.getRT() for spec in exp), dtype=np.float64, count=exp.getNrSpectra())
     if end == -1:
-        end = spectra[-1].getRT()
-    exp.setSpectra([spec for spec in exp.getSpectra()
-                   if spec.getRT() > start and spec.getRT() < end])
+        end = rts[-1]
+    exp.setSpectra([exp.getSpectrum(int(i)) for i in np.flatnonzero((rts > start) & (rts < end))])
 
     return exp
 
@@ -105,19 +181,13 @@ def feature_detection(exp, mtd_custom_params={}, epd_custom_params={}, ffm_custo
     exp.sortSpectra(True)
     mass_traces = []
     mtd = MassTraceDetection()
-    mtd_params = mtd.getDefaults()
-    for k, v in mtd_custom_params.items():
-        mtd_params.setValue(k, v)
-    mtd.setParameters(mtd_params)
+    mtd.setParameters(_get_params(MassTraceDetection, mtd_custom_params))
     mtd.run(exp, mass_traces, 0)
 
     mass_traces_split = []
     mass_traces_final = []
     epd = ElutionPeakDetection()
-    epd_params = epd.getDefaults()
-    for k, v in epd_custom_params.items():
-        epd_params.setValue(k, v)
-    epd.setParameters(epd_params)
+    epd.setParameters(_get_params(ElutionPeakDetection, epd_custom_params))
     epd.detectPeaks(mass_traces, mass_traces_split)
 
     if (epd.getParameters().getValue("width_filtering") == "auto"):
@@ -128,10 +198,7 @@ def feature_detection(exp, mtd_custom_params={}, epd_custom_params={}, ffm_custo
     feature_map_FFM = FeatureMap()
     feat_chrom = []
     ffm = FeatureFindingMetabo()
-    ffm_params = ffm.getDefaults()
-    for k, v in ffm_custom_params.items():
-        ffm_params.setValue(k, v)
-    ffm.setParameters(ffm_params)
+    ffm.setParameters(_get_params(FeatureFindingMetabo, ffm_custom_params))
     ffm.run(mass_traces_final, feature_map_FFM, feat_chrom)
     feature_map_FFM.setUniqueIds()
     feature_map_FFM.setPrimaryMSRunPath([mzML_file_name.encode()])
@@ -211,9 +278,9 @@ def filter_feature_map(fm, q):
 
     fm_filtered.setPrimaryMSRunPath([_get_mzML_name_from_fm(fm).encode()])
 
-    for f in fm:
-        if f.getOverallQuality() > q:
-            fm_filtered.push_back(f)
+    qualities = np.fromiter((f.getOverallQuality() for f in fm), dtype=np.float64, count=fm.size())
+    for i in np.flatnonzero(qualities > q):
+        fm_filtered.push_back(fm[int(i)])
 
     print('Features before quality filter: ' + str(fm.size()))
     print('Features after quality filter: ' + str(fm_filtered.size()))
@@ -236,9 +303,9 @@ def map_alignment(fms, visualize=False):
     list of pyopenms.FeatureMap
         FeatureMaps with aligned RTs.
     """
-    # set ref_index to feature map index with largest number of features
-    ref_index = [i[0] for i in sorted(
-        enumerate([fm.size() for fm in fms]), key=lambda x:x[1])][-1]
+    # set ref_index to feature map index with largest number of features (last one if several have the same size)
+    sizes = np.fromiter((fm.size() for fm in fms), dtype=np.int64, count=len(fms))
+    ref_index = len(fms) - 1 - int(sizes[::-1].argmax())
 
     aligner = MapAlignmentAlgorithmPoseClustering()
 
@@ -253,6 +320,8 @@ def map_alignment(fms, visualize=False):
         transformer.transformRetentionTimes(fm, trafo, True)
 
     if visualize:
+        import matplotlib.pyplot as plt
+
         fmaps = [fms[ref_index]] + fms[:ref_index] + fms[ref_index+1:]
 
         fig = plt.figure(figsize=(10, 5))
@@ -262,21 +331,24 @@ def map_alignment(fms, visualize=False):
         ax.set_ylabel('m/z')
         ax.set_xlabel('RT')
 
-        # use alpha value to display feature intensity
-        ax.scatter([f.getRT() for f in fmaps[0]], [f.getMZ() for f in fmaps[0]],
-                   alpha=np.asarray([f.getIntensity() for f in fmaps[0]])/max([f.getIntensity() for f in fmaps[0]]))
+        # get feature coordinates once per map, RTs before alignment are stored as meta value (except reference)
+        dfs = [fm.get_df()[['RT', 'mz', 'intensity']] for fm in fmaps]
+        original_rts = [dfs[0]['RT'].to_numpy()] + [
+            np.fromiter((f.getMetaValue('original_RT') for f in fm), dtype=np.float64, count=fm.size())
+            for fm in fmaps[1:]]
 
-        for fm in fmaps[1:]:
-            ax.scatter([f.getMetaValue('original_RT') for f in fm], [f.getMZ() for f in fm],
-                       alpha=np.asarray([f.getIntensity() for f in fm])/max([f.getIntensity() for f in fm]))
+        # use alpha value to display feature intensity
+        for rt, df in zip(original_rts, dfs):
+            intensity = df['intensity'].to_numpy()
+            ax.scatter(rt, df['mz'].to_numpy(), alpha=intensity/intensity.max())
 
         ax = fig.add_subplot(1, 2, 2)
         ax.set_title('consensus map after alignment')
         ax.set_xlabel('RT')
 
-        for fm in fmaps:
-            ax.scatter([f.getRT() for f in fm], [f.getMZ() for f in fm],
-                       alpha=np.asarray([f.getIntensity() for f in fm])/max([f.getIntensity() for f in fm]))
+        for df in dfs:
+            intensity = df['intensity'].to_numpy()
+            ax.scatter(df['RT'].to_numpy(), df['mz'].to_numpy(), alpha=intensity/intensity.max())
 
         fig.tight_layout()
 
@@ -303,10 +375,7 @@ def feature_linking(fms, params={}):
     """
     feature_grouper = FeatureGroupingAlgorithmQT()
 
-    par = feature_grouper.getDefaults()
-    for k, v in params.items():
-        par.setValue(k, v)
-    feature_grouper.setParameters(par)
+    feature_grouper.setParameters(_get_params(FeatureGroupingAlgorithmQT, params))
 
     cm = ConsensusMap()
 
@@ -326,6 +395,39 @@ def feature_linking(fms, params={}):
     return cm
 
 
+_AMS_FILE_PARAMS = ("positive_adducts", "negative_adducts", "db:mapping", "db:struct")
+
+
+def _ams_file_key(path):
+    """Return absolute path and modification time of an AccurateMassSearch input file (None if missing)."""
+    path = os.path.abspath(path)
+    try:
+        return path, os.path.getmtime(path)
+    except OSError:
+        # let AccurateMassSearchEngine report missing files
+        return path, None
+
+
+@functools.lru_cache(maxsize=4)
+def _get_ams_engine(params, file_keys):
+    """Return an initialized AccurateMassSearchEngine for the given (name, value) parameter pairs.
+
+    Engines are cached, so adduct and database files are only parsed once for the same parameters.
+    file_keys (absolute paths and modification times of the input files) only serve as cache key,
+    so engines are rebuilt when the files are modified.
+    """
+    ams = AccurateMassSearchEngine()
+
+    par = ams.getParameters()
+    for key, value in params:
+        par.setValue(key, list(value) if isinstance(value, tuple) else value)
+    ams.setParameters(par)
+
+    ams.init()
+
+    return ams
+
+
 def accurate_mass_search(cm, params={}):
     """Perform accurate mass search on ConsensusMap.
 
@@ -340,29 +442,32 @@ def accurate_mass_search(cm, params={}):
     pyopenms.ConsensusMap
         ConsensusMap containing all given FeatureMaps.
     """
-    ams = AccurateMassSearchEngine()
-
-    par = ams.getParameters()
-    for key, value in params.items():
-        par.setValue(key, value)
-    ams.setParameters(par)
+    # lists (e.g. database files) are converted to tuples to be usable as cache key
+    ams_params = tuple((key, tuple(value) if isinstance(value, list) else value)
+                       for key, value in params.items())
+    file_keys = tuple(
+        _ams_file_key(path)
+        for key, value in ams_params
+        if (key.decode() if isinstance(key, bytes) else key) in _AMS_FILE_PARAMS
+        for path in (value if isinstance(value, tuple) else (value,))
+    )
+    ams = _get_ams_engine(ams_params, file_keys)
 
     mztab = MzTab()
 
-    ams.init()
-
     ams.run(cm, mztab)
 
-    MzTabFile().store('ids_temp.tsv', mztab)
-
-    df = pd.read_csv('ids_temp.tsv', header=None, sep='\n')
-    df = df[0].str.split('\t', expand=True)
+    # store mzTab in a temporary directory (not the working directory), removed right after reading
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mztab_path = os.path.join(tmp_dir, 'ids.mzTab')
+        MzTabFile().store(mztab_path, mztab)
 
-    id_df = df.loc[df[0] == 'SML']
-    id_df.columns = df.loc[df[0] == 'SMH'].iloc[0]
-    #id_df.reset_index(drop=True, inplace=True)
+        # only the small molecule section is needed (header SMH and rows SML)
+        with open(mztab_path, 'r') as mztab_file:
+            sml_lines = [line for line in mztab_file if line.startswith(('SMH', 'SML'))]
 
-    os.remove('ids_temp.tsv')
+    id_df = pd.read_csv(io.StringIO(''.join(sml_lines)), sep='\t', dtype=str,
+                        na_filter=False, quoting=csv.QUOTE_NONE)
 
     return id_df
 
@@ -1,8 +1,95 @@
-import seaborn as sns
-import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
 
 
-def plot_result_df(df):
+def _select_labels(labels):
+    """Return unique labels in given order, selecting labels missing from the DataFrame raises KeyError."""
+    return list(dict.fromkeys(labels))
+
+
+def _tick_step(n_labels, ticklabels):
+    """Return the step between labelled ticks for seaborn style ticklabels ("auto", bool or int), 0 for no labels."""
+    if ticklabels is False:
+        return 0
+    if ticklabels is True:
+        return 1
+    if ticklabels == "auto":
+        return max(1, n_labels // 50)
+    return int(ticklabels)
+
+
+def _heatmap(df, cmap, annot=False, center=None, xticklabels=True, yticklabels=True):
+    """Plot a heatmap of the DataFrame and return its Axes.
+
+    Large DataFrames (more than 10000 cells) are drawn as a single image with imshow instead of seaborn's per cell mesh.
+    Cells are only annotated for DataFrames with up to 2500 cells.
+    """
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
+    if df.size <= 10000:
+        return sns.heatmap(
+            df,
+            cmap=cmap,
+            annot=annot and df.size <= 2500,
+            center=center,
+            xticklabels=xticklabels,
+            yticklabels=yticklabels,
+        )
+
+    values = df.to_numpy(dtype=np.float64)
+    vmin, vmax = None, None
+    if center is not None:
+        # color range symmetric around center like in seaborn
+        vrange = np.nanmax(np.abs(values - center))
+        vmin, vmax = center - vrange, center + vrange
+
+    ax = plt.gca()
+    image = ax.imshow(
+        values, aspect="auto", cmap=cmap, interpolation="nearest", vmin=vmin, vmax=vmax
+    )
+    ax.figure.colorbar(image, ax=ax)
+
+    for axis, labels, ticklabels in (
+        (ax.xaxis, df.columns, xticklabels),
+        (ax.yaxis, df.index, yticklabels),
+    ):
+        step = _tick_step(len(labels), ticklabels)
+        positions = np.arange(0, len(labels), step) if step else []
+        axis.set_ticks(positions)
+        axis.set_ticklabels(labels[positions])
+
+    return ax
+
+
+def _bar_plot(df, df_err=None):
+    """Plot grouped bars (one group per row, one bar per column) like DataFrame.plot.bar and return the Axes."""
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    x = np.arange(len(df.index))
+    # bars of a group share a width of 0.5 as in pandas
+    width = 0.5 / max(1, len(df.columns))
+    offsets = (np.arange(len(df.columns)) - (len(df.columns) - 1) / 2) * width
+    for offset, column in zip(offsets, df.columns):
+        ax.bar(
+            x + offset,
+            df[column].to_numpy(),
+            width,
+            yerr=None if df_err is None else df_err[column].to_numpy(),
+            capsize=2,
+            ecolor="#555555",
+            label=column,
+        )
+    ax.set_xticks(x)
+    ax.set_xticklabels(df.index, rotation=60)
+    ax.set_xlabel(df.index.name or "")
+    ax.set_xlim(-0.5, len(df.index) - 0.5)
+    ax.legend()
+    return ax
+
+
+def plot_result_df(df, xticklabels=True, yticklabels=True):
     """Generate a heatmap from DataFrame with IDs and intensity values per sample
 
     This requires a DataFrame that has been generated with the id_by_accurate_mass workflow.
@@ -11,12 +98,18 @@ def plot_result_df(df):
     ----------
     df : pandas DataFrame
         DataFrame for plotting.
+    xticklabels : "auto", bool or int (default : True)
+        Sample labels as in seaborn.heatmap ("auto" skips labels if they would overlap, False hides them).
+    yticklabels : "auto", bool or int (default : True)
+        ID labels as in seaborn.heatmap ("auto" skips labels if they would overlap, False hides them).
     """
-    chart = sns.heatmap(
-        df, xticklabels=df.columns, yticklabels=df.index, cmap="afmhot_r"
+    import matplotlib.pyplot as plt
+
+    chart = _heatmap(
+        df, cmap="afmhot_r", xticklabels=xticklabels, yticklabels=yticklabels
     )
 
-    chart.set_xticklabels(chart.get_xticklabels(), rotation=45)
+    chart.tick_params(axis="x", rotation=45)
 
     plt.show()
 
@@ -39,17 +132,20 @@ def plot_intensities(df_mean, df_std, samples=[], metabolites=[], title="", ylab
     ylabel : string
         Custom y axis label for the plot.
     """
+    import matplotlib.pyplot as plt
+
     if samples:
+        samples = _select_labels(samples)
         df_mean = df_mean[samples]
         df_std = df_std[samples]
     if metabolites:
+        metabolites = _select_labels(metabolites)
         df_mean = df_mean.loc[metabolites]
         df_std = df_std.loc[metabolites]
-    bar = df_mean.plot.bar(yerr=df_std, ecolor="#555555", capsize=2)
+    bar = _bar_plot(df_mean, df_std)
     bar.ticklabel_format(
         axis="y", style="scientific", scilimits=(0, 0), useMathText=True
     )
-    bar.set_xticklabels(bar.get_xticklabels(), rotation=60)
     plt.ylabel(ylabel)
     plt.title(title)
     plt.tight_layout()
@@ -72,12 +168,13 @@ def plot_fold_change(df_change, samples=[], metabolites=[], title="", ylabel="")
     ylabel : string
         Custom y axis label for the plot.
     """
+    import matplotlib.pyplot as plt
+
     if samples:
-        df_change = df_change[samples]
+        df_change = df_change[_select_labels(samples)]
     if metabolites:
-        df_change = df_change.loc[metabolites]
-    bar = df_change.plot.bar()
-    bar.set_xticklabels(bar.get_xticklabels(), rotation=60)
+        df_change = df_change.loc[_select_labels(metabolites)]
+    _bar_plot(df_change)
     plt.ylabel(ylabel)
     plt.title(title)
     plt.tight_layout()
@@ -85,7 +182,13 @@ def plot_fold_change(df_change, samples=[], metabolites=[], title="", ylabel="")
 
 
 def plot_fold_change_heatmap(
-    df_change, samples=[], metabolites=[], title="", annotate=True
+    df_change,
+    samples=[],
+    metabolites=[],
+    title="",
+    annotate=True,
+    xticklabels=True,
+    yticklabels=True,
 ):
     """Generate a heatmap from DataFrame with IDs and intensity values per sample
 
@@ -102,23 +205,29 @@ def plot_fold_change_heatmap(
     title : string
         Custom title for the plot.
     annotate : bool (default : True)
-        Annotate heatmap cells with actual values.
+        Annotate heatmap cells with actual values (only for up to 2500 cells).
+    xticklabels : "auto", bool or int (default : True)
+        Sample labels as in seaborn.heatmap ("auto" skips labels if they would overlap, False hides them).
+    yticklabels : "auto", bool or int (default : True)
+        Metabolite labels as in seaborn.heatmap ("auto" skips labels if they would overlap, False hides them).
     """
+    import matplotlib.pyplot as plt
+
     if samples:
-        df_change = df_change[samples]
+        df_change = df_change[_select_labels(samples)]
     if metabolites:
-        df_change = df_change.loc[metabolites]
+        df_change = df_change.loc[_select_labels(metabolites)]
 
-    chart = sns.heatmap(
+    chart = _heatmap(
         df_change,
-        xticklabels=df_change.columns,
-        yticklabels=df_change.index,
         cmap="bwr",
         annot=annotate,
-        center=0
+        center=0,
+        xticklabels=xticklabels,
+        yticklabels=yticklabels,
     )
 
-    chart.set_xticklabels(chart.get_xticklabels(), rotation=45)
+    chart.tick_params(axis="x", rotation=45)
 
     chart.set_title(title)
 
@@ -130,8 +239,20 @@ def plotDetectedFeatures3D(fm, title=""):
 
     The FeatureMap needs ConvexHulls.
 
+    Parameters
+    ----------
+    fm : pyopenms.FeatureMap
+        FeatureMap with features to plot.
+    title : string
+        Custom title for the plot.
 
+    Returns
+    -------
+    matplotlib.figure.Figure
+        The figure, can be closed by the caller once it has been shown.
     """
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
     ax = fig.add_subplot(111, projection="3d")
 
@@ -139,10 +260,19 @@ def plotDetectedFeatures3D(fm, title=""):
         color = next(ax._get_lines.prop_cycler)["color"]
         # chromatogram data is stored in the subordinates of the feature
         for i, sub in enumerate(feature.getSubordinates()):
-            retention_times = [x[0] for x in sub.getConvexHulls()[0].getHullPoints()]
-            intensities = [int(y[1]) for y in sub.getConvexHulls()[0].getHullPoints()]
+            hull_points = sub.getConvexHulls()[0].getHullPoints()
+            retention_times = hull_points[:, 0]
+            intensities = hull_points[:, 1].astype(int)
             mz = sub.getMetaValue("MZ")
-            ax.plot(retention_times, intensities, zs=mz, zdir="x", color=color)
+            # rasterize chromatogram lines, a map can contain many features
+            ax.plot(
+                retention_times,
+                intensities,
+                zs=mz,
+                zdir="x",
+                color=color,
+                rasterized=True,
+            )
             if i == 0:
                 ax.text(
                     mz,
@@ -156,3 +286,5 @@ def plotDetectedFeatures3D(fm, title=""):
     ax.set_xlabel("m/z")
     ax.set_zlabel("intensity (cps)")
     plt.show()
+
+    return fig
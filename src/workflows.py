@@ -1,9 +1,135 @@
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+
 from src.processing import *
 from src.analysis import *
-from src.visualization import *
+from src.visualization import plotDetectedFeatures3D
+
+
+# parameters for FeatureFinderMetabo (MassTraceDetection, ElutionPeakDetection, FeatureFindingMetabo) in id_by_mz
+_FD_MTD_PARAMS = {
+    "mass_error_ppm": 10.0,  # default: 10
+    "noise_threshold_int": 3000.0,
+}
+_FD_EPD_PARAMS = {"width_filtering": "fixed"}
+_FD_FFM_PARAMS = {
+    "isotope_filtering_model": "none",
+    "remove_single_traces": "true",
+    "mz_scoring_by_elements": "false",
+    "report_convex_hulls": "true",
+}
+
+# parameters for FeatureLinkerUnlabeledQT in id_by_mz
+_FL_PARAMS = {
+    "distance_MZ:unit": "ppm",  # default: ppm
+    "distance_MZ:max_difference": 10.0,  # default: 10
+    "distance_RT:max_difference": 20.0,  # default: 20
+}
+
+# parameters for AccurateMassSearch in id_by_mz (ionization_mode is set per call)
+_AMS_PARAMS = {
+    "positive_adducts": "data/AccurateMassSearch/positive_adducts.tsv",
+    "negative_adducts": "data/AccurateMassSearch/negative_adducts.tsv",
+    "db:mapping": ["data/AccurateMassSearch/pgn_maps.tsv"],
+    "db:struct": ["data/AccurateMassSearch/pgn_structs.tsv"],
+    "mass_error_unit": "ppm",  # default: ppm
+    "mass_error_value": 5.0,  # default: 5
+}
+
+# parameters and compound libraries per polarity for FeatureFinderMetaboIdent in id_by_mz_and_rt
+_FFMID_PARAMS = {b"extract:mz_window": 15.0}
+_FFMID_LIBRARIES = {
+    "negative": "data/FeatureFinderMetaboIdent/standards_neg.tsv",
+    "positive": "data/FeatureFinderMetaboIdent/standards_pos.tsv",
+}
+
+
+def _list_mzML(mzML_directory):
+    """Return paths of all mzML files in the given directory."""
+    with os.scandir(mzML_directory) as entries:
+        return [entry.path for entry in entries if entry.name.endswith(".mzML")]
+
+
+def _strip_qbic(columns):
+    """Remove QBiC codes (CODE_) from beginning of sample names, names without _ are kept."""
+    stripped = columns.str.split("_", n=1).str[1]
+    return stripped.where(stripped.notna(), columns)
+
+
+def _detect_features(mzML_path):
+    """Detect features in a mzML file and return the FeatureMap."""
+    exp = load_experiment(mzML_path)
+
+    exp = filter_experiment(exp, start=120, end=550)
+
+    fm = feature_detection(
+        exp,
+        mzML_file_name=os.path.basename(mzML_path),
+        mtd_custom_params=_FD_MTD_PARAMS,
+        epd_custom_params=_FD_EPD_PARAMS,
+        ffm_custom_params=_FD_FFM_PARAMS,
+    )
+
+    return fm
+
+
+def _detect_features_ident(mzML_path, library):
+    """Same as _detect_features, but with FeatureFinderMetaboIdent and the given compound library."""
+    exp = load_experiment(mzML_path)
+
+    exp = filter_experiment(exp, start=100)
 
+    fm = feature_detection_ident(
+        exp,
+        mzML_path,
+        library,
+        ffmid_custom_params=_FFMID_PARAMS,
+    )
+
+    return fm
+
+
+def _detect_and_store(detect, featureXML_directory, mzML_path, *args):
+    """Run detect in a worker process and store the FeatureMap in featureXML_directory, returns the featureXML path."""
+    featureXML_file = os.path.join(
+        featureXML_directory, os.path.basename(mzML_path)[:-5] + ".featureXML"
+    )
+    FeatureXMLFile().store(featureXML_file, detect(mzML_path, *args))
 
-def id_by_mz(mzML_directory, polarity, remove_qbic=True):
+    return featureXML_file
+
+
+def _detect_features_parallel(detect, mzML_paths, *args, max_workers=1):
+    """Run detect on each mzML file and return the FeatureMaps in file order.
+
+    Additional args are passed to detect for each file. With max_workers=1 the files are processed one after
+    another in this process. Otherwise each file is processed in one of max_workers worker processes (None for
+    the number of CPUs), each holding a complete MSExperiment in memory. Workers are spawned, forking a process
+    that already ran multi-threaded OpenMS code (e.g. a previous workflow run) can deadlock. FeatureMaps can't
+    be pickled, so they are passed back as featureXML files, which store intensities and qualities with only
+    ~7 significant digits.
+    """
+    if max_workers == 1:
+        return [detect(mzML_path, *args) for mzML_path in mzML_paths]
+
+    with tempfile.TemporaryDirectory() as featureXML_directory:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            featureXML_files = list(
+                executor.map(
+                    partial(_detect_and_store, detect, featureXML_directory),
+                    mzML_paths,
+                    *[repeat(arg) for arg in args],
+                )
+            )
+        return [load_feature_map(file) for file in featureXML_files]
+
+
+def id_by_mz(mzML_directory, polarity, remove_qbic=True, max_workers=1):
     """Processes all mzML files in given directory and identify metabolites by mz.
 
     - Filter RTs
@@ -22,64 +148,29 @@ def id_by_mz(mzML_directory, polarity, remove_qbic=True):
         Specify polarity of MS data 'negative' or 'positive' for AMS.
     remove_qbic : bool (default : True)
         Remove QBiC codes from beginning of sample name (CODE_).
+    max_workers : int (default : 1)
+        Number of worker processes for feature detection (1 = sequential in-process, None = number of CPUs).
 
     Returns
     -------
     pandas.DataFrame
         With grouped metabolite identifications and intensity values per sample.
     """
-    fms = []
-
-    for mzML_file in [
-        file for file in os.listdir(mzML_directory) if file.endswith(".mzML")
-    ]:
-        exp = load_experiment(os.path.join(mzML_directory, mzML_file))
-
-        exp = filter_experiment(exp, start=120, end=550)
-
-        fm = feature_detection(
-            exp,
-            mzML_file_name=mzML_file,
-            mtd_custom_params={
-                "mass_error_ppm": 10.0,  # default: 10
-                "noise_threshold_int": 3000.0,
-            },
-            epd_custom_params={"width_filtering": "fixed"},
-            ffm_custom_params={
-                "isotope_filtering_model": "none",
-                "remove_single_traces": "true",
-                "mz_scoring_by_elements": "false",
-                "report_convex_hulls": "true",
-            },
-        )
-
-        fms.append(fm)
-
-    fms = map_alignment(fms)
-
-    cm = feature_linking(
-        fms,
-        params={
-            "distance_MZ:unit": "ppm",  # default: ppm
-            "distance_MZ:max_difference": 10.0,  # default: 10
-            "distance_RT:max_difference": 20.0,  # default: 20
-        },
+    fms = _detect_features_parallel(
+        _detect_features, _list_mzML(mzML_directory), max_workers=max_workers
     )
 
+    # alignment needs at least two maps
+    if len(fms) > 1:
+        fms = map_alignment(fms)
+
+    cm = feature_linking(fms, params=_FL_PARAMS)
+
     ams_df = accurate_mass_search(
-        cm,
-        params={
-            "ionization_mode": polarity,
-            "positive_adducts": "data/AccurateMassSearch/positive_adducts.tsv",
-            "negative_adducts": "data/AccurateMassSearch/negative_adducts.tsv",
-            "db:mapping": ["data/AccurateMassSearch/pgn_maps.tsv"],
-            "db:struct": ["data/AccurateMassSearch/pgn_structs.tsv"],
-            "mass_error_unit": "ppm",  # default: ppm
-            "mass_error_value": 5.0,  # default: 5
-        },
+        cm, params={"ionization_mode": polarity, **_AMS_PARAMS}
     )
-    cm_df = cm.get_df()
-    cm_df = filter_df(cm_df, 0)
+    # ConsensusMap DataFrame is built only once, filtering selects rows with a boolean mask
+    cm_df = filter_df(cm.get_df(), 0)
 
     df = annotate_cm_df(cm_df, ams_df)
 
@@ -92,7 +183,7 @@ def id_by_mz(mzML_directory, polarity, remove_qbic=True):
     print(df)
     
     if remove_qbic:
-        df.columns = ["_".join(c.split("_")[1:]) for c in df.columns]
+        df.columns = _strip_qbic(df.columns)
 
     return df
 
@@ -102,6 +193,8 @@ def id_by_mz_and_rt(
     polarity="negative",
     remove_qbic=True,
     plot_intermediate_results=True,
+    verbose=False,
+    max_workers=1,
 ):
     """Processes all mzML files in given directory and identify metabolites by mz and RT.
 
@@ -121,50 +214,53 @@ def id_by_mz_and_rt(
         Remove QBiC codes from beginning of sample name (CODE_).
     plot_intermediate_results : bool (default : True)
         Plot intermediate results from FeatureMaps with identified compounds.
+    verbose : bool (default : False)
+        Print the first identified features per file.
+    max_workers : int (default : 1)
+        Number of worker processes for feature detection (1 = sequential in-process, None = number of CPUs).
 
     Returns
     -------
     pandas.DataFrame
         With grouped metabolite identifications and intensity values per sample.
     """
-    fms = []
+    # raises KeyError for polarities other than 'negative' and 'positive'
+    library = _FFMID_LIBRARIES[polarity]
+
+    mzML_paths = _list_mzML(mzML_directory)
 
-    for mzML_file in [
-        file for file in os.listdir(mzML_directory) if file.endswith(".mzML")
-    ]:
+    fms = _detect_features_parallel(
+        _detect_features_ident, mzML_paths, library, max_workers=max_workers
+    )
 
-        exp = load_experiment(os.path.join(mzML_directory, mzML_file))
+    if plot_intermediate_results:
+        import matplotlib.pyplot as plt
 
-        exp = filter_experiment(exp, start=100)
+    # bound once, used to read the label of every feature
+    get_meta_value = Feature.getMetaValue
 
-        if polarity == "negative":
-            library = "data/FeatureFinderMetaboIdent/standards_neg.tsv"
-        elif polarity == "positive":
-            library = "data/FeatureFinderMetaboIdent/standards_pos.tsv"
+    for i, (mzML_path, fm) in enumerate(zip(mzML_paths, fms)):
+        mzML_name = os.path.basename(mzML_path)[:-5]
 
-        fm = feature_detection_ident(
-            exp,
-            os.path.join(mzML_directory, mzML_file),
-            library,
-            ffmid_custom_params={b"extract:mz_window": 15.0},
-        )
         if plot_intermediate_results:
-            plotDetectedFeatures3D(fm, title=mzML_file[:-5])
+            # close figures after they have been shown, otherwise pyplot keeps all of them open
+            plt.close(plotDetectedFeatures3D(fm, title=mzML_name))
 
         fm = filter_feature_map(fm, 0.0)
 
-        df = fm.get_df()[['mz', 'RT', 'intensity']]
-
-        df['id'] = [f.getMetaValue('label') for f in fm]
-
-        print(mzML_file[:-5])
-        print(df)
+        # feature DataFrame is only needed for the preview
+        if verbose:
+            df = fm.get_df()[["mz", "RT", "intensity"]].assign(
+                id=pd.array([get_meta_value(f, "label") for f in fm], dtype="string")
+            )
+            print(mzML_name)
+            print(df.head().to_string())
 
-        fms.append(fm)
+        fms[i] = fm
 
     df = group_metabolites_ffmid(fms)
 
     if remove_qbic:
-        df.columns = ["_".join(c.split("_")[1:]) for c in df.columns]
+        df.columns = _strip_qbic(df.columns)
 
     return df